@@ -1,17 +1,35 @@
 import os
-import io
+import re
+import json
+import base64
+import random
+import time
+import asyncio
+import sqlite3
+import threading
 import uuid
+import hashlib
 import logging
 import datetime
-from typing import Optional, List
+from typing import Optional
 
+import aiofiles
+import jwt
+from jwt.algorithms import RSAAlgorithm
+import requests
+from requests.adapters import HTTPAdapter
 import soundfile as sf
-import speech_recognition as sr
-from fastapi import FastAPI, File, UploadFile, HTTPException, Depends
+import soxr
+from faster_whisper import WhisperModel
+from fastapi import FastAPI, File, UploadFile, HTTPException, Depends, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from fastapi.security import OAuth2PasswordBearer
-from google.oauth2 import id_token
-from google.auth.transport import requests as google_requests
+from fastapi.staticfiles import StaticFiles
+from fastapi_cache import FastAPICache
+from fastapi_cache.backends.inmemory import InMemoryBackend
+from fastapi_cache.decorator import cache
+from starlette.concurrency import run_in_threadpool
 from dotenv import load_dotenv
 
 # Configure logging
@@ -21,7 +39,7 @@ logger = logging.getLogger(__name__)
 # Load environment variables
 load_dotenv()
 
-app = FastAPI(title="Personalized Diary Backend")
+app = FastAPI(title="Personalized Diary Backend", default_response_class=ORJSONResponse)
 
 # OAuth2 configuration
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
@@ -37,36 +55,262 @@ app.add_middleware(
 
 # Google OAuth Configuration
 GOOGLE_CLIENT_ID = "852882200826-n5ai58l4sg8gpikheeja2md5ibp9dg5u.apps.googleusercontent.com"
+# Shared pooled session so cert fetches reuse keep-alive connections
+# to googleapis.com instead of paying a TLS handshake per request
+_google_session = requests.Session()
+_google_session.mount("https://", HTTPAdapter(pool_connections=32, pool_maxsize=32))
+GOOGLE_JWKS_URI = "https://www.googleapis.com/oauth2/v3/certs"
+GOOGLE_ISSUERS = ("https://accounts.google.com", "accounts.google.com")
+JWKS_REFRESH_SECONDS = 3600
+JWKS_FETCH_ATTEMPTS = 4
+_RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+TOKEN_CACHE_TTL_SECONDS = 300
+
+# Google's signing keys: kid -> RSA public key, refreshed hourly
+_jwks_keys: dict = {}
+_jwks_fetched_at = 0.0
+_jwks_lock = threading.Lock()
 UPLOAD_DIRECTORY = "uploads"
+UPLOAD_DIR_PREFIX = UPLOAD_DIRECTORY + os.sep
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MiB per read when streaming uploads to disk
+
+# Characters allowed in stored filenames; everything else becomes "_"
+_SAFE_FILENAME_RE = re.compile(r'[^A-Za-z0-9._-]')
+
+def new_entry_id() -> str:
+    """Generate a compact 22-char base64url entry id"""
+    return base64.urlsafe_b64encode(uuid.uuid4().bytes).rstrip(b'=').decode()
+
+# Transcription batching: collapse clips arriving within a short window
+# into one worker pass instead of transcribing per-request
+TRANSCRIBE_BATCH_SIZE = 16
+TRANSCRIBE_BATCH_WINDOW_SECONDS = 0.05
+WHISPER_MODEL_SIZE = os.getenv("WHISPER_MODEL", "small.en")
+WHISPER_SAMPLE_RATE = 16000
+
+_whisper_model: Optional[WhisperModel] = None
+_whisper_lock = threading.Lock()
+
+# Verified token cache: sha256(token) -> (idinfo, expires_at)
+_TOKEN_CACHE: dict = {}
+_token_cache_lock = threading.Lock()
+
+_transcribe_queue: Optional[asyncio.Queue] = None
+_transcribe_worker_task: Optional[asyncio.Task] = None
 
 # Ensure upload directory exists
 os.makedirs(UPLOAD_DIRECTORY, exist_ok=True)
 
-# Temporary in-memory storage for entries (replace with a database in production)
-DIARY_ENTRIES: List[dict] = []
+# Serve uploads via StaticFiles so downloads take the kernel sendfile
+# path instead of a Python read loop
+app.mount("/files", StaticFiles(directory=UPLOAD_DIRECTORY), name="files")
+
+# SQLite storage: WAL mode so readers don't block writers across
+# workers, FTS5 so keyword search hits a real inverted index
+DATABASE_PATH = os.getenv("DATABASE_PATH", "diary.db")
+
+db = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
+db.execute("PRAGMA journal_mode=WAL")
+db.execute(
+    "CREATE VIRTUAL TABLE IF NOT EXISTS entries_fts "
+    "USING fts5(id UNINDEXED, text, files UNINDEXED, created_at UNINDEXED)"
+)
+db.commit()
+_db_lock = threading.Lock()
+
+_WORD_RE = re.compile(r"\w+")
+
+def _row_to_entry(row) -> dict:
+    return {
+        "id": row[0],
+        "text": row[1],
+        "files": json.loads(row[2]),
+        "created_at": row[3]
+    }
+
+def insert_entry(entry: dict) -> None:
+    """Persist an entry to the FTS-backed entries table"""
+    with _db_lock:
+        db.execute(
+            "INSERT INTO entries_fts VALUES (?, ?, ?, ?)",
+            (
+                entry['id'],
+                entry['text'],
+                json.dumps(entry['files']),
+                entry['created_at'].isoformat()
+            )
+        )
+        db.commit()
+
+def fetch_entries() -> list:
+    """Load all entries in creation order"""
+    with _db_lock:
+        rows = db.execute(
+            "SELECT id, text, files, created_at FROM entries_fts ORDER BY created_at"
+        ).fetchall()
+    return [_row_to_entry(row) for row in rows]
+
+def search_entries(query: str) -> list:
+    """Keyword-search entry text through the FTS5 index"""
+    tokens = _WORD_RE.findall(query.lower())
+    if not tokens:
+        return []
+
+    # Prefix-match each token so partial words still hit the index
+    match = " ".join(f'"{token}"*' for token in tokens)
+    with _db_lock:
+        rows = db.execute(
+            "SELECT id, text, files, created_at FROM entries_fts "
+            "WHERE entries_fts MATCH ? ORDER BY created_at",
+            (match,)
+        ).fetchall()
+    return [_row_to_entry(row) for row in rows]
+
+def _fetch_jwks() -> dict:
+    """Fetch Google's JWKS with bounded exponential backoff.
+
+    Honors Retry-After on throttled responses so a transient 429/5xx
+    doesn't bubble up as a failed login.
+    """
+    delay = 1.0
+    for attempt in range(JWKS_FETCH_ATTEMPTS):
+        response = _google_session.get(GOOGLE_JWKS_URI, timeout=10)
+        if response.status_code in _RETRYABLE_STATUSES and attempt < JWKS_FETCH_ATTEMPTS - 1:
+            # Jitter only the local backoff; a server-sent Retry-After
+            # is a floor we must not undercut
+            wait = min(delay, 60) * (0.5 + random.random())
+            retry_after = response.headers.get('Retry-After')
+            if retry_after and retry_after.isdigit():
+                wait = max(float(retry_after), wait)
+            time.sleep(wait)
+            delay *= 2
+            continue
+        response.raise_for_status()
+        return response.json()
+
+def _get_google_public_key(kid: str):
+    """Return the RSA public key for a Google cert kid, refreshing hourly"""
+    global _jwks_fetched_at
+    with _jwks_lock:
+        if kid not in _jwks_keys or time.time() - _jwks_fetched_at > JWKS_REFRESH_SECONDS:
+            jwks = _fetch_jwks()
+            _jwks_keys.clear()
+            for jwk in jwks["keys"]:
+                _jwks_keys[jwk["kid"]] = RSAAlgorithm.from_jwk(jwk)
+            _jwks_fetched_at = time.time()
+        return _jwks_keys[kid]
+
+def verify_google_token(token: str) -> dict:
+    """Verify a Google ID token, caching results for repeated tokens"""
+    key = hashlib.sha256(token.encode()).hexdigest()
+    with _token_cache_lock:
+        cached = _TOKEN_CACHE.get(key)
+        if cached and time.time() < cached[1]:
+            return cached[0]
 
-def speech_to_text(audio_bytes: bytes) -> str:
-    """Convert audio to text using speech recognition"""
-    recognizer = sr.Recognizer()
-    
     try:
-        with BytesIO(audio_bytes) as audio_file:
-            with sf.SoundFile(audio_file) as sound_file:
-                audio_data = recognizer.record(
-                    sr.AudioFile(sf.SoundFile(audio_file))
-                )
-                text = recognizer.recognize_google(audio_data)
-                return text
+        kid = jwt.get_unverified_header(token)["kid"]
+        idinfo = jwt.decode(
+            token,
+            key=_get_google_public_key(kid),
+            algorithms=["RS256"],
+            audience=GOOGLE_CLIENT_ID
+        )
+    except (jwt.PyJWTError, KeyError) as e:
+        raise ValueError(f"Token verification failed: {e}")
+    if idinfo.get('iss') not in GOOGLE_ISSUERS:
+        raise ValueError(f"Wrong issuer: {idinfo.get('iss')}")
+
+    expires_at = min(idinfo['exp'], time.time() + TOKEN_CACHE_TTL_SECONDS)
+    with _token_cache_lock:
+        _TOKEN_CACHE[key] = (idinfo, expires_at)
+
+        # Drop expired entries so the cache doesn't grow without bound
+        now = time.time()
+        for stale in [k for k, (_, exp) in _TOKEN_CACHE.items() if exp <= now]:
+            _TOKEN_CACHE.pop(stale, None)
+
+    return idinfo
+
+def _get_whisper_model() -> WhisperModel:
+    """Load the shared faster-whisper model on first use"""
+    global _whisper_model
+    with _whisper_lock:
+        if _whisper_model is None:
+            _whisper_model = WhisperModel(
+                WHISPER_MODEL_SIZE,
+                device="cpu",
+                compute_type="int8",
+                cpu_threads=max(1, (os.cpu_count() or 2) // 2),
+                num_workers=2
+            )
+        return _whisper_model
+
+def speech_to_text(audio_file) -> str:
+    """Convert audio to text with the local faster-whisper model"""
+    try:
+        # Downmix and resample to the 16 kHz mono float32 the model
+        # expects, so its internal decode/resample pass is skipped
+        data, sample_rate = sf.read(audio_file, dtype='float32', always_2d=True)
+        mono = data.mean(axis=1)
+        if sample_rate != WHISPER_SAMPLE_RATE:
+            mono = soxr.resample(mono, sample_rate, WHISPER_SAMPLE_RATE)
+
+        segments, _ = _get_whisper_model().transcribe(
+            mono, vad_filter=True, beam_size=1
+        )
+        return " ".join(segment.text.strip() for segment in segments)
     except Exception as e:
         logger.error(f"Speech recognition error: {e}")
         return ""
 
-def save_file(content: bytes, filename: str) -> str:
-    """Save file to upload directory and return file path"""
+async def _transcription_worker():
+    """Drain queued audio clips in small batches with bounded parallelism"""
+    while True:
+        batch = [await _transcribe_queue.get()]
+        deadline = time.monotonic() + TRANSCRIBE_BATCH_WINDOW_SECONDS
+        while len(batch) < TRANSCRIBE_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_transcribe_queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+
+        results = await asyncio.gather(
+            *(run_in_threadpool(speech_to_text, audio_file) for audio_file, _ in batch),
+            return_exceptions=True
+        )
+        for (_, future), result in zip(batch, results):
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+async def transcribe_audio(audio_file) -> str:
+    """Queue a clip for the shared transcription worker and await its text"""
+    future = asyncio.get_running_loop().create_future()
+    await _transcribe_queue.put((audio_file, future))
+    return await future
+
+@app.on_event("startup")
+async def start_transcription_worker():
+    global _transcribe_queue, _transcribe_worker_task
+    _transcribe_queue = asyncio.Queue()
+    _transcribe_worker_task = asyncio.create_task(_transcription_worker())
+
+@app.on_event("startup")
+async def init_response_cache():
+    FastAPICache.init(InMemoryBackend())
+
+async def save_file(upload: UploadFile, filename: str) -> str:
+    """Stream an upload to the upload directory and return the file path"""
     try:
-        file_path = os.path.join(UPLOAD_DIRECTORY, filename)
-        with open(file_path, "wb") as f:
-            f.write(content)
+        file_path = f"{UPLOAD_DIR_PREFIX}{filename}"
+        async with aiofiles.open(file_path, "wb") as f:
+            while chunk := await upload.read(UPLOAD_CHUNK_SIZE):
+                await f.write(chunk)
         return file_path
     except Exception as e:
         logger.error(f"File save error: {e}")
@@ -76,12 +320,9 @@ def save_file(content: bytes, filename: str) -> str:
 async def login(token: str):
     """Authenticate user via Google OAuth token"""
     try:
-        # Verify Google token
-        idinfo = id_token.verify_oauth2_token(
-            token, 
-            google_requests.Request(), 
-            GOOGLE_CLIENT_ID
-        )
+        # Verify Google token off the event loop; it fetches Google's
+        # certs over HTTPS and would otherwise block other requests
+        idinfo = await run_in_threadpool(verify_google_token, token)
         
         return {
             "status": "success", 
@@ -96,6 +337,20 @@ async def login(token: str):
         logger.error(f"Token verification failed: {e}")
         raise HTTPException(status_code=403, detail="Invalid authentication token")
 
+async def _store_image(entry_id: str, image: UploadFile) -> tuple:
+    """Save an uploaded image and return its file record"""
+    image_filename = f"{entry_id}_{_SAFE_FILENAME_RE.sub('_', image.filename)}"
+    await save_file(image, image_filename)
+    return {"type": "image", "file_id": f"/files/{image_filename}"}, ""
+
+async def _store_audio(entry_id: str, audio: UploadFile) -> tuple:
+    """Save an uploaded audio clip and return its record and transcription"""
+    audio_filename = f"{entry_id}_{_SAFE_FILENAME_RE.sub('_', audio.filename)}"
+    await save_file(audio, audio_filename)
+    await audio.seek(0)
+    transcription = await transcribe_audio(audio.file)
+    return {"type": "audio", "file_id": f"/files/{audio_filename}"}, transcription
+
 @app.post("/entries")
 async def add_diary_entry(
     text: Optional[str] = None, 
@@ -112,45 +367,31 @@ async def add_diary_entry(
             )
 
         # Generate unique entry ID
-        entry_id = str(uuid.uuid4())
-        timestamp = datetime.datetime.now()
+        entry_id = new_entry_id()
+        timestamp = datetime.datetime.now(datetime.timezone.utc)
 
         # Prepare entry data
         entry = {
             "id": entry_id,
             "text": text or "",
             "files": [],
-            "created_at": timestamp.isoformat()
+            "created_at": timestamp
         }
 
-        # Handle image upload
-        if image:
-            image_content = await image.read()
-            image_filename = f"{entry_id}_{image.filename}"
-            image_path = save_file(image_content, image_filename)
-            entry['files'].append({
-                "type": "image",
-                "file_id": image_path
-            })
-
-        # Handle audio upload
-        if audio:
-            audio_content = await audio.read()
-            audio_filename = f"{entry_id}_{audio.filename}"
-            audio_path = save_file(audio_content, audio_filename)
-            
-            # Optional: Transcribe audio
-            transcription = speech_to_text(audio_content)
+        # Handle image and audio uploads concurrently; they are
+        # independent, so the request takes max() not sum() of the two
+        results = await asyncio.gather(
+            *([_store_image(entry_id, image)] if image else []),
+            *([_store_audio(entry_id, audio)] if audio else [])
+        )
+        for record, transcription in results:
+            entry['files'].append(record)
             if transcription and not text:
                 entry['text'] += transcription
 
-            entry['files'].append({
-                "type": "audio",
-                "file_id": audio_path
-            })
-
         # Store entry
-        DIARY_ENTRIES.append(entry)
+        await run_in_threadpool(insert_entry, entry)
+        await FastAPICache.clear(namespace="entries")
         logger.info(f"Diary entry created: {entry_id}")
 
         return entry
@@ -160,18 +401,26 @@ async def add_diary_entry(
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/entries")
-async def get_diary_entries():
+@cache(expire=60, namespace="entries")
+async def get_diary_entries(request: Request, response: Response):
     """Retrieve all diary entries"""
-    return DIARY_ENTRIES
+    return await run_in_threadpool(fetch_entries)
 
 @app.get("/entries/search")
-async def search_diary_entries(query: str):
+@cache(expire=60, namespace="entries")
+async def search_diary_entries(query: str, request: Request, response: Response):
     """Search diary entries by keywords"""
-    return [
-        entry for entry in DIARY_ENTRIES 
-        if query.lower() in entry['text'].lower()
-    ]
+    return await run_in_threadpool(search_entries, query)
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WEB_CONCURRENCY", "1")),
+        loop="uvloop",
+        http="httptools",
+        limit_concurrency=1024,
+        backlog=2048,
+    )